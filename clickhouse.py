@@ -1,6 +1,25 @@
+import os
+import json
+import hashlib
 import logging
+import datetime
+import gzip
+import zlib
 import requests
 import utils
+import side_tables
+import throttle
+import dedup
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 config = utils.get_config()
 CH_HOST = config['clickhouse']['host']
@@ -9,33 +28,79 @@ CH_PASSWORD = config['clickhouse']['password']
 CH_VISITS_TABLE = config['clickhouse']['visits_table']
 CH_HITS_TABLE = config['clickhouse']['hits_table']
 CH_DATABASE = config['clickhouse']['database']
+CH_DEDUP = config['clickhouse'].get('dedup', False)
+CH_COMPRESSION = config['clickhouse'].get('compression', 'none')
+CH_COMPRESSION_LEVEL = config['clickhouse'].get('compression_level', 3)
+CH_ROLLUPS = config['clickhouse'].get('rollups', [])
+CH_SIDE_TABLES = config['clickhouse'].get('side_tables', False)
+CH_THROTTLE = config['clickhouse'].get('throttle', {})
 
 logger = logging.getLogger('logs_api')
 
+if (CH_COMPRESSION == 'zstd' and zstandard is None) or (CH_COMPRESSION == 'lz4' and lz4 is None):
+    logger.warning('Python package for {codec} compression is not installed, gzip is used'
+                   .format(codec=CH_COMPRESSION))
+    CH_COMPRESSION = 'gzip'
+
+# keep-alive HTTP connections are reused between queries and loads
+session = requests.Session()
+
+# tables known to exist, so repeated loads skip the metadata queries
+present_tables = set()
+
+# side tables already saved for parts (keyed by content digest) which failed to be inserted into main table
+saved_side_tables = {}
 
-def get_data(query, host=CH_HOST):
+limits = throttle.get_limits(CH_THROTTLE, 'clickhouse', config['dump_path'])
+
+
+def get_data(query, host=CH_HOST, params=None):
     """Returns ClickHouse response"""
     logger.debug(query)
     if (CH_USER == '') and (CH_PASSWORD == ''):
-        r = requests.post(host, data=query)
+        r = session.post(host, data=query, params=params)
     else:
-        r = requests.post(host, data=query, auth=(CH_USER, CH_PASSWORD))
+        r = session.post(host, data=query, params=params, auth=(CH_USER, CH_PASSWORD))
     if r.status_code == 200:
         return r.text
     else:
         raise ValueError(r.text)
 
 
-def upload(table, content, host=CH_HOST):
-    """Uploads data to table in ClickHouse"""
+def compress(content: bytes, codec=CH_COMPRESSION, level=CH_COMPRESSION_LEVEL) -> bytes:
+    """Returns content compressed with codec supported by ClickHouse HTTP interface"""
+    if codec == 'gzip':
+        return gzip.compress(content, compresslevel=level)
+    elif codec == 'deflate':
+        return zlib.compress(content, level)
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(content)
+    elif codec == 'lz4':
+        return lz4.frame.compress(content, compression_level=level)
+    else:
+        raise ValueError('Wrong argument: codec = ' + codec)
+
+
+def insert(table, content, host=CH_HOST, columns=None):
+    """Sends data to table in ClickHouse (to listed columns only, if columns are given)"""
+    if columns is not None:
+        table = '{table} ({columns})'.format(table=table, columns=', '.join(columns))
     query_dict = {
-        'query': 'INSERT INTO ' + table + ' FORMAT TabSeparatedWithNames '
+        'query': 'INSERT INTO ' + table + ' FORMAT TabSeparatedWithNames ',
+        'enable_http_compression': 1
     }
+    headers = {}
+    if CH_COMPRESSION != 'none':
+        raw_size = len(content)
+        content = compress(content)
+        headers['Content-Encoding'] = CH_COMPRESSION
+        logger.info('{raw} bytes compressed to {wire} bytes ({codec})'
+                    .format(raw=raw_size, wire=len(content), codec=CH_COMPRESSION))
     if (CH_USER == '') and (CH_PASSWORD == ''):
-        r = requests.post(host, data=content, params=query_dict)
+        r = session.post(host, data=content, params=query_dict, headers=headers)
     else:
-        r = requests.post(host, data=content, params=query_dict,
-                          auth=(CH_USER, CH_PASSWORD))
+        r = session.post(host, data=content, params=query_dict, headers=headers,
+                         auth=(CH_USER, CH_PASSWORD))
     result = r.text
     if r.status_code == 200:
         return result
@@ -43,6 +108,46 @@ def upload(table, content, host=CH_HOST):
         raise ValueError(r.text)
 
 
+def is_overloaded(error) -> bool:
+    """Returns whether insert failed because server is overloaded"""
+    message = str(error)
+    return any(m in message for m in ('TOO_MANY_PARTS', 'Too many parts',
+                                      'TOO_MANY_SIMULTANEOUS_QUERIES', 'Too many simultaneous queries'))
+
+
+def is_busy(table) -> bool:
+    """Returns whether server has more running queries or table has more active parts in a partition
+        than allowed by throttle config"""
+    max_running_queries = CH_THROTTLE.get('max_running_queries', 0)
+    if max_running_queries > 0:
+        queries = get_data("SELECT value FROM system.metrics WHERE metric = 'Query'").strip()
+        if int(queries or 0) > max_running_queries:
+            return True
+
+    max_parts_in_partition = CH_THROTTLE.get('max_parts_in_partition', 0)
+    if max_parts_in_partition > 0:
+        db, table_name = table.split('.', 1) if '.' in table else (CH_DATABASE, table)
+        parts = get_data('''
+            SELECT max(cnt)
+            FROM (
+                SELECT count() cnt
+                FROM system.parts
+                WHERE active AND database = '{db}' AND table = '{table}'
+                GROUP BY partition
+            )
+        '''.format(db=db, table=table_name)).strip()
+        if int(parts or 0) > max_parts_in_partition:
+            return True
+    return False
+
+
+def upload(table, content, host=CH_HOST, columns=None):
+    """Uploads data to table in ClickHouse within throttle limits"""
+    with throttle.insert_slot(limits, content):
+        return throttle.with_backoff(limits, lambda: insert(table, content, host, columns), is_overloaded,
+                                     lambda: is_busy(table))
+
+
 def get_source_table_name(source, with_db=True):
     """Returns table name in database"""
     if source == 'hits':
@@ -84,6 +189,11 @@ def create_db():
     return get_data('CREATE DATABASE {db}'.format(db=CH_DATABASE))
 
 
+def get_columns_of_data(data: bytes) -> list:
+    """Returns column names for the header of TSV data from Logs API"""
+    return [get_ch_field_name(f) for f in data.split(b'\n', 1)[0].decode('utf8').split('\t')]
+
+
 def get_ch_field_name(field_name):
     """Converts Logs API parameter name to ClickHouse column name"""
     prefixes = ['ym:s:', 'ym:pv:']
@@ -97,6 +207,8 @@ def drop_table(source):
     query = 'DROP TABLE IF EXISTS {table}'.format(
         table=get_source_table_name(source))
     get_data(query)
+    present_tables.discard(get_source_table_name(source))
+    dedup.clear_index(config['dump_path'], 'clickhouse', source)
 
 
 def create_table(source, fields):
@@ -111,18 +223,25 @@ def create_table(source, fields):
 
     table_name = get_source_table_name(source)
     if source == 'hits':
-        if ('ym:pv:date' in fields) and ('ym:pv:clientID' in fields):
-            engine = 'MergeTree(Date, intHash32(ClientID), (Date, intHash32(ClientID)), 8192)'
-        else:
-            engine = 'Log'
+        prefix, id_field = 'ym:pv:', 'ym:pv:watchID'
     elif source == 'visits':
-        if ('ym:s:date' in fields) and ('ym:s:clientID' in fields):
-            engine = 'MergeTree(Date, intHash32(ClientID), (Date, intHash32(ClientID)), 8192)'
-        else:
-            engine = 'Log'
+        prefix, id_field = 'ym:s:', 'ym:s:visitID'
     else:
         raise ValueError('Wrong argument: source = ' + source)
 
+    if (prefix + 'date' in fields) and (prefix + 'clientID' in fields):
+        if CH_DEDUP and (id_field in fields):
+            # rows with the same ID are collapsed by background merges
+            engine = 'ReplacingMergeTree(Date, intHash32(ClientID), (Date, intHash32(ClientID), {id}), 8192)' \
+                .format(id=get_ch_field_name(id_field))
+        else:
+            if CH_DEDUP:
+                logger.warning('{id} is required in fields for ReplacingMergeTree, MergeTree is used'
+                               .format(id=id_field))
+            engine = 'MergeTree(Date, intHash32(ClientID), (Date, intHash32(ClientID)), 8192)'
+    else:
+        engine = 'Log'
+
     ch_field_types = utils.get_fields_config()
     ch_fields = list(map(get_ch_field_name, fields))
 
@@ -138,15 +257,156 @@ def create_table(source, fields):
     get_data(query)
 
 
-def save_data(user_req, data, part=None):
-    """Inserts data into ClickHouse table"""
-    if not is_db_present():
-        create_db()
+def create_side_table(table_name, columns, order_by):
+    """Creates side table for exploded params or goals"""
+    tmpl = '''
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            {fields}
+        ) ENGINE = MergeTree(Date, ({order}), 8192)
+    '''
+    query = tmpl.format(table_name=table_name,
+                        fields=',\n'.join('{name} {type}'.format(name=c[0], type=c[1]) for c in columns),
+                        order=', '.join(order_by))
+    get_data(query)
+
+
+def save_side_tables(user_req, data, saved):
+    """Explodes params and goals arrays of the part and inserts them into side tables.
+        Side tables in saved are skipped, names of inserted ones are added to it"""
+    for suffix, columns, order_by, content in side_tables.explode(user_req.source, data, get_ch_field_name):
+        table = '{table}_{suffix}'.format(table=get_source_table_name(user_req.source), suffix=suffix)
+        if table in saved:
+            continue
+        if table not in present_tables:
+            create_side_table(table, columns, order_by)
+            present_tables.add(table)
+        upload(table, content)
+        saved.add(table)
+
+
+def get_columns(source) -> list:
+    """Returns list of column names of the table"""
+    rows = get_data('DESCRIBE TABLE {table}'.format(table=get_source_table_name(source))).strip().split('\n')
+    return [r.split('\t')[0] for r in rows if r != '']
+
+
+def reconcile_table(source):
+    """Adds columns for fields from config which are missing in existing table"""
+    fields = config['{source}_fields'.format(source=source)]
+    ch_field_types = utils.get_fields_config()
+    columns = get_columns(source)
+    for field in fields:
+        if get_ch_field_name(field) not in columns:
+            get_data('ALTER TABLE {table} ADD COLUMN {name} {type}'
+                     .format(table=get_source_table_name(source), name=get_ch_field_name(field),
+                             type=ch_field_types[field]))
+            logger.info('Column {name} is added to {table}'
+                        .format(name=get_ch_field_name(field), table=get_source_table_name(source)))
 
-    if not is_table_present(user_req.source):
-        create_table(user_req.source, user_req.fields)
 
-    upload(get_source_table_name(user_req.source), data)
+def get_backfill_table_name(user_req) -> str:
+    """Returns name of Join table collecting all parts of backfill request"""
+    return '{table}_backfill_{suffix}'.format(table=get_source_table_name(user_req.source),
+                                              suffix=utils.get_backfill_suffix(user_req))
+
+
+def prepare_backfill(user_req):
+    """Drops Join table left by a failed backfill request, so its data is not mixed with the new one"""
+    get_data('DROP TABLE IF EXISTS {table}'.format(table=get_backfill_table_name(user_req)))
+
+
+def backfill(user_req, data, part=None):
+    """Loads part of backfill data (key fields and backfilled ones) to Join table of the request,
+        rows are updated by apply_backfill when all parts are loaded"""
+    ch_field_types = utils.get_fields_config()
+    id_column = get_ch_field_name(utils.ID_FIELDS[user_req.source])
+    get_data('''
+        CREATE TABLE IF NOT EXISTS {table} (
+            {fields},
+            BackfillPresent UInt8 DEFAULT 1
+        ) ENGINE = Join(ANY, LEFT, {id})
+    '''.format(table=get_backfill_table_name(user_req), id=id_column,
+               fields=',\n'.join('{name} {type}'.format(name=get_ch_field_name(f), type=ch_field_types[f])
+                                 for f in user_req.fields)))
+    # BackfillPresent is not in data and takes its default
+    upload(get_backfill_table_name(user_req), data, columns=get_columns_of_data(data))
+
+
+def apply_backfill(user_req):
+    """Fills columns of already loaded rows of the date range by their visit (hit) ID from Join table
+        with all parts of backfill request. A single mutation rewrites the columns once for the whole request"""
+    id_column = get_ch_field_name(utils.ID_FIELDS[user_req.source])
+    key_columns = list(map(get_ch_field_name, utils.get_key_fields(user_req.source)))
+    columns = list(map(get_ch_field_name, user_req.fields))
+    join_table = get_backfill_table_name(user_req)
+    get_data('''
+        ALTER TABLE {table}
+        UPDATE {updates}
+        WHERE Date >= '{start_date}' AND Date <= '{end_date}' AND CounterID = {counter}
+            AND joinGet('{join_table}', 'BackfillPresent', {id}) = 1
+    '''.format(table=get_source_table_name(user_req.source), join_table=join_table, id=id_column,
+               updates=', '.join("{name} = joinGet('{join_table}', '{name}', {id})"
+                                 .format(name=c, join_table=join_table, id=id_column)
+                                 for c in columns if c not in key_columns),
+               start_date=user_req.start_date_str, end_date=user_req.end_date_str,
+               counter=user_req.counter_id),
+             params={'mutations_sync': 1, 'allow_nondeterministic_mutations': 1})
+    # Join table is kept if the update fails, so it can be retried without loading parts again
+    get_data('DROP TABLE IF EXISTS {table}'.format(table=join_table))
+
+
+def save_data(user_req, data, part=None):
+    """Inserts data into ClickHouse table"""
+    table = get_source_table_name(user_req.source)
+    if table not in present_tables:
+        if not is_db_present():
+            create_db()
+
+        if not is_table_present(user_req.source):
+            if user_req.backfill:
+                raise ValueError('Unable to backfill: table {table} does not exist'.format(table=table))
+            create_table(user_req.source, user_req.fields)
+        else:
+            reconcile_table(user_req.source)
+        present_tables.add(table)
+
+    if user_req.backfill:
+        backfill(user_req, data, part)
+        return
+
+    # columns are listed by the header, as their order in table may differ from the order of fields in config
+    if not CH_SIDE_TABLES:
+        upload(table, data, columns=get_columns_of_data(data))
+        return
+
+    # side tables go first and are remembered until the main insert succeeds,
+    # so a retry of the part inserts neither of them twice
+    digest = hashlib.md5(data).hexdigest()
+    save_side_tables(user_req, data, saved_side_tables.setdefault(digest, set()))
+    upload(table, data, columns=get_columns_of_data(data))
+    saved_side_tables.pop(digest, None)
+
+
+def delete_data(user_request):
+    """Deletes rows of the counter for date range of the request (side tables included), so it can be loaded again"""
+    if not is_db_present() or not is_table_present(user_request.source):
+        return
+
+    tables = get_tables()
+    for table in [get_source_table_name(user_request.source)] + \
+            ['{table}_{suffix}'.format(table=get_source_table_name(user_request.source), suffix=suffix)
+             for suffix in ('params', 'goals')]:
+        if table.split('.', 1)[1] not in tables:
+            continue
+        get_data('''
+            ALTER TABLE {table}
+            DELETE WHERE Date >= '{start_date}' AND Date <= '{end_date}' AND CounterID = {counter}
+        '''.format(table=table, start_date=user_request.start_date_str, end_date=user_request.end_date_str,
+                   counter=user_request.counter_id),
+                 params={'mutations_sync': 1})
+    logger.info('Data for counter_id = {counter}, {start} - {end} is deleted from {table}'
+                .format(counter=user_request.counter_id, start=user_request.start_date_str,
+                        end=user_request.end_date_str, table=get_source_table_name(user_request.source)))
 
 
 def is_data_present(user_request):
@@ -170,12 +430,189 @@ def is_data_present(user_request):
 
 
 def data_missing_time_spans(user_request) -> tuple:
-    """IMPLEMENT LATER"""
-    pass
+    """Returns tuple of date spans of the form (start_date, end_date) for the given request parameters
+        (user_request.counter_id, user_request.start_date_str, user_request.end_date_str)"""
+    if not is_db_present() or not is_table_present(user_request.source):
+        return tuple([(user_request.start_date_str, user_request.end_date_str)])
+
+    query = '''
+        SELECT
+            Date,
+            count() cnt
+        FROM {table}
+        WHERE Date >= '{start_date}' AND Date <= '{end_date}'
+            AND CounterID = {counter}
+        GROUP BY Date
+        ORDER BY Date
+        FORMAT TabSeparated
+    '''.format(table=get_source_table_name(user_request.source),
+               start_date=user_request.start_date_str,
+               end_date=user_request.end_date_str,
+               counter=user_request.counter_id)
+
+    rows = get_data(query).strip().split('\n')
+    dates = [datetime.datetime.strptime(r.split('\t')[0], utils.DATE_FORMAT).date() for r in rows if r != '']
+    return utils.get_missing_spans(user_request.start_date_str, user_request.end_date_str, dates)
+
+
+def get_rollup_table_name(rollup, with_db=True):
+    """Returns rollup table name in database"""
+    if with_db:
+        return '{db}.{table}'.format(db=CH_DATABASE, table=rollup['name'])
+    else:
+        return rollup['name']
+
+
+def is_rollup_table_present(rollup):
+    """Returns whether rollup table is already present in database"""
+    return get_rollup_table_name(rollup, with_db=False) in get_tables()
+
+
+def get_rollup_columns(rollup) -> list:
+    """Returns list of (name, type, select expression) for rollup table columns"""
+    fields = config['{source}_fields'.format(source=rollup['source'])]
+    ch_field_types = utils.get_fields_config()
+    column_types = {get_ch_field_name(f): ch_field_types[f] for f in fields}
+    aggregating = any(m['function'] not in ('count', 'sum') for m in rollup['metrics'])
+
+    columns = [('Date', 'Date', 'Date'), ('CounterID', column_types['CounterID'], 'CounterID')]
+    for dimension in rollup['dimensions']:
+        columns.append((dimension, column_types[dimension], dimension))
+
+    for metric in rollup['metrics']:
+        if metric['function'] == 'count':
+            col_type, expression = 'UInt64', 'toUInt64(count())'
+        elif metric['function'] == 'sum':
+            col_type, expression = 'Int64', 'toInt64(sum({column}))'.format(column=metric['column'])
+        else:
+            col_type = 'AggregateFunction({function}, {type})'.format(function=metric['function'],
+                                                                       type=column_types[metric['column']])
+            expression = '{function}State({column})'.format(function=metric['function'], column=metric['column'])
+        if aggregating and metric['function'] in ('count', 'sum'):
+            col_type = 'SimpleAggregateFunction(sum, {type})'.format(type=col_type)
+        columns.append((metric['name'], col_type, expression))
+    return columns
+
+
+def create_rollup_table(rollup):
+    """Creates rollup table partitioned by month, so it can be recomputed month by month"""
+    tmpl = '''
+        CREATE TABLE {table_name} (
+            {fields}
+        ) ENGINE = {engine}
+        PARTITION BY toYYYYMM(Date)
+        ORDER BY ({order})
+    '''
+    aggregating = any(m['function'] not in ('count', 'sum') for m in rollup['metrics'])
+    columns = get_rollup_columns(rollup)
+    query = tmpl.format(table_name=get_rollup_table_name(rollup),
+                        fields=',\n'.join('{name} {type}'.format(name=c[0], type=c[1]) for c in columns),
+                        engine='AggregatingMergeTree()' if aggregating else 'SummingMergeTree()',
+                        order=', '.join(['CounterID', 'Date'] + rollup['dimensions']))
+    get_data(query)
+    logger.info('Rollup table is created: {name}'.format(name=get_rollup_table_name(rollup)))
 
 
-def clean_data(source):
-    """Stub for compliance with interface"""
-    pass
+def fill_rollup(rollup, span=None, table=None):
+    """Inserts aggregates of raw data into rollup table (or table of the same structure)
+        for date span (or for all dates)"""
+    columns = get_rollup_columns(rollup)
+    group_by = ', '.join(['Date', 'CounterID'] + rollup['dimensions'])
+    query = '''
+        INSERT INTO {rollup_table}
+        SELECT {expressions}
+        FROM {table} {final}
+        {where}
+        GROUP BY {group_by}
+    '''.format(rollup_table=get_rollup_table_name(rollup) if table is None else table,
+               expressions=', '.join(c[2] for c in columns),
+               table=get_source_table_name(rollup['source']),
+               final='FINAL' if CH_DEDUP else '',
+               where='' if span is None else "WHERE Date >= '{start}' AND Date <= '{end}'"
+               .format(start=span[0], end=span[1]),
+               group_by=group_by)
+    get_data(query)
 
 
+def get_source_span(source):
+    """Returns date span of all data in source table (None if it is empty)"""
+    rows = get_data('SELECT min(Date), max(Date) FROM {table} HAVING count() > 0'
+                    .format(table=get_source_table_name(source))).strip()
+    if rows == '':
+        return None
+    return tuple(rows.split('\t'))
+
+
+def refresh_rollup(rollup, spans):
+    """Recomputes rollup only for days of loaded date spans (for all days when rollup table is created).
+        Every touched month is built in staging table: recomputed days are aggregated from raw table,
+        other days are copied from rollup. Then the month is swapped into rollup with REPLACE PARTITION,
+        so readers never see days missing and every insert writes a single partition"""
+    if not is_rollup_table_present(rollup):
+        create_rollup_table(rollup)
+        source_span = get_source_span(rollup['source'])
+        spans = [] if source_span is None else [source_span]
+
+    days_by_month = {}
+    for span in utils.merge_spans(spans):
+        start_date = datetime.datetime.strptime(span[0], utils.DATE_FORMAT)
+        end_date = datetime.datetime.strptime(span[1], utils.DATE_FORMAT)
+        for i in range((end_date - start_date).days + 1):
+            day = start_date + datetime.timedelta(i)
+            days_by_month.setdefault(day.strftime('%Y%m'), []).append(day.strftime(utils.DATE_FORMAT))
+
+    table = get_rollup_table_name(rollup)
+    staging_table = table + '_staging'
+    get_data('CREATE TABLE IF NOT EXISTS {staging} AS {table}'.format(staging=staging_table, table=table))
+    for month, days in sorted(days_by_month.items()):
+        get_data('TRUNCATE TABLE {staging}'.format(staging=staging_table))
+        get_data('''
+            INSERT INTO {staging}
+            SELECT *
+            FROM {table}
+            WHERE toYYYYMM(Date) = {month} AND Date NOT IN ({days})
+        '''.format(staging=staging_table, table=table, month=month,
+                   days=', '.join("'{day}'".format(day=d) for d in days)))
+        for span in utils.merge_spans([(d, d) for d in days]):
+            fill_rollup(rollup, span, staging_table)
+        get_data('ALTER TABLE {table} REPLACE PARTITION {month} FROM {staging}'
+                 .format(table=table, month=month, staging=staging_table))
+    get_data('TRUNCATE TABLE {staging}'.format(staging=staging_table))
+
+
+def get_pending_rollups_file() -> str:
+    """Returns path of the file with date spans of rollups that failed to refresh"""
+    return os.path.join(config['dump_path'], 'rollups_pending.json')
+
+
+def get_pending_rollups() -> dict:
+    """Returns dict {rollup name: [date spans]} left by failed refreshes"""
+    pending = {}
+    if os.path.exists(get_pending_rollups_file()):
+        with open(get_pending_rollups_file()) as input_file:
+            pending.update(json.loads(input_file.read()))
+    return pending
+
+
+def clean_data(source, spans=()):
+    """Maintains rollup tables of source for the date spans just loaded.
+        Spans of failed refreshes are saved to dump_path and retried by the next run"""
+    if not is_table_present(source):
+        return
+
+    pending = get_pending_rollups()
+    for rollup in CH_ROLLUPS:
+        if rollup['source'] != source:
+            continue
+        rollup_spans = utils.merge_spans([tuple(s) for s in list(spans) + pending.get(rollup['name'], [])])
+        if len(rollup_spans) == 0:
+            continue
+        logger.info('### REFRESHING ROLLUP {name} for {spans}'.format(name=rollup['name'], spans=rollup_spans))
+        try:
+            refresh_rollup(rollup, rollup_spans)
+            pending.pop(rollup['name'], None)
+        except Exception as e:
+            pending[rollup['name']] = rollup_spans
+            logger.warning('Unable to refresh rollup {name}, it will be retried by the next run: {error}'
+                           .format(name=rollup['name'], error=e))
+        utils.write_json_atomic(get_pending_rollups_file(), pending)
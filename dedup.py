@@ -0,0 +1,102 @@
+import os
+import shutil
+import logging
+import datetime
+from array import array
+from bisect import bisect_left
+from heapq import merge
+import utils
+
+logger = logging.getLogger('logs_api')
+
+DATE_FIELDS = {'visits': 'ym:s:date', 'hits': 'ym:pv:date'}
+
+
+def get_index_dir(dump_path, dest_name, source) -> str:
+    """Returns directory with IDs loaded to destination for source"""
+    return os.path.join(dump_path, 'dedup_index', dest_name, source)
+
+
+def get_index_file(user_req, dest_name, date_str) -> str:
+    """Returns path of the file with IDs loaded to destination for counter, source and day"""
+    index_dir = os.path.join(get_index_dir(user_req.dump_path, dest_name, user_req.source),
+                             str(user_req.counter_id))
+    return os.path.join(index_dir, '{date}.ids'.format(date=date_str))
+
+
+def load_ids(index_file) -> array:
+    """Returns sorted array of IDs stored in index file (unsigned 64-bit integers, 8 bytes per ID)"""
+    ids = array('Q')
+    if os.path.exists(index_file):
+        with open(index_file, 'rb') as input_file:
+            ids.frombytes(input_file.read())
+    return ids
+
+
+def contains(ids: array, row_id) -> bool:
+    """Returns whether sorted array of IDs contains row_id"""
+    i = bisect_left(ids, row_id)
+    return i < len(ids) and ids[i] == row_id
+
+
+def clear_index(dump_path, dest_name, source):
+    """Removes IDs loaded to destination for source, e.g. when the table is dropped"""
+    shutil.rmtree(get_index_dir(dump_path, dest_name, source), ignore_errors=True)
+
+
+def reset(user_req, dest_name):
+    """Removes IDs for days of the user request. Days are requested only when destination reports them
+        as missing, so IDs left from a dropped table or deleted data would make every row to be dropped"""
+    start_date = datetime.datetime.strptime(user_req.start_date_str, utils.DATE_FORMAT)
+    end_date = datetime.datetime.strptime(user_req.end_date_str, utils.DATE_FORMAT)
+    for i in range((end_date - start_date).days + 1):
+        index_file = get_index_file(user_req, dest_name,
+                                    (start_date + datetime.timedelta(i)).strftime(utils.DATE_FORMAT))
+        if os.path.exists(index_file):
+            logger.warning('Data for {file} is missing in {dest}, deduplication index is reset'
+                           .format(file=index_file, dest=dest_name))
+            os.remove(index_file)
+
+
+def filter_rows(user_req, dest_name, rows) -> tuple:
+    """Drops rows with IDs already loaded for the same counter and day.
+        Returns filtered rows (header included) and dict {date: [new IDs]} to commit after upload"""
+    header = rows[0].split('\t')
+    if (utils.ID_FIELDS[user_req.source] not in header) or (DATE_FIELDS[user_req.source] not in header):
+        logger.warning('Deduplication is skipped: {id} and {date} fields are required'
+                       .format(id=utils.ID_FIELDS[user_req.source], date=DATE_FIELDS[user_req.source]))
+        return rows, {}
+    id_pos = header.index(utils.ID_FIELDS[user_req.source])
+    date_pos = header.index(DATE_FIELDS[user_req.source])
+
+    # IDs loaded before are kept in compact sorted arrays, only IDs of the part are in sets
+    loaded, new_ids = {}, {}
+    result = [rows[0]]
+    for row in rows[1:]:
+        values = row.split('\t')
+        date_str, row_id = values[date_pos], int(values[id_pos])
+        if date_str not in loaded:
+            loaded[date_str] = load_ids(get_index_file(user_req, dest_name, date_str))
+            new_ids[date_str] = set()
+        if (row_id in new_ids[date_str]) or contains(loaded[date_str], row_id):
+            continue
+        new_ids[date_str].add(row_id)
+        result.append(row)
+
+    num_duplicates = len(rows) - len(result)
+    if num_duplicates != 0:
+        logger.info('{num} duplicate rows were dropped for {dest}'.format(num=num_duplicates, dest=dest_name))
+    return result, new_ids
+
+
+def commit(user_req, dest_name, new_ids):
+    """Merges IDs of uploaded rows into sorted index files"""
+    for date_str, ids in new_ids.items():
+        if len(ids) == 0:
+            continue
+        index_file = get_index_file(user_req, dest_name, date_str)
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        merged = array('Q', merge(load_ids(index_file), sorted(ids)))
+        with open(index_file + '.tmp', 'wb') as output_file:
+            merged.tofile(output_file)
+        os.replace(index_file + '.tmp', index_file)
@@ -0,0 +1,184 @@
+import os
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+import vertica
+
+logger = logging.getLogger('logs_api')
+
+WORKER_ID = '{host}:{pid}'.format(host=socket.gethostname(), pid=os.getpid())
+
+# lease tables known to exist
+present_tables = set()
+
+
+class LeaseLost(Exception):
+    """Lease has expired and the unit may be loaded by another worker"""
+
+
+def get_backend(lease_conf) -> str:
+    """Returns lease backend: sqlite (workers on a single host) or vertica (workers on several hosts)"""
+    backend = lease_conf.get('backend', 'sqlite')
+    if backend not in ('sqlite', 'vertica'):
+        raise ValueError('Wrong argument: leases.backend = ' + backend)
+    return backend
+
+
+def get_table_name(lease_conf) -> str:
+    """Returns name of lease table"""
+    if get_backend(lease_conf) == 'vertica':
+        return lease_conf.get('table', 'logs_api_leases')
+    return 'leases'
+
+
+def get_connection(lease_conf):
+    """Returns connection to lease database (SQLite file or Vertica), lease table is created if missing.
+        Both connections use ? placeholders, changes are committed explicitly"""
+    if get_backend(lease_conf) == 'vertica':
+        con = vertica.get_handler().con
+    else:
+        con = sqlite3.connect(lease_conf['path'], timeout=60)
+
+    if get_table_name(lease_conf) not in present_tables:
+        con.execute('''
+            CREATE TABLE IF NOT EXISTS {table} (
+                counter VARCHAR(64),
+                source VARCHAR(16),
+                start_date VARCHAR(10),
+                end_date VARCHAR(10),
+                worker VARCHAR(256),
+                expires FLOAT,
+                done INTEGER,
+                PRIMARY KEY (counter, source, start_date, end_date)
+            )
+        '''.format(table=get_table_name(lease_conf)))
+        con.commit()
+        present_tables.add(get_table_name(lease_conf))
+    return con
+
+
+def lock(lease_conf, con):
+    """Locks lease table until the end of transaction, so claims of workers are serialized"""
+    if get_backend(lease_conf) == 'vertica':
+        con.execute('LOCK TABLE {table} IN EXCLUSIVE MODE'.format(table=get_table_name(lease_conf)))
+    else:
+        con.execute('BEGIN IMMEDIATE')
+
+
+def get_now(lease_conf, con) -> float:
+    """Returns current time of lease database, so clocks of worker hosts may differ"""
+    if get_backend(lease_conf) == 'vertica':
+        return float(con.execute('SELECT EXTRACT(EPOCH FROM STATEMENT_TIMESTAMP())').fetchone()[0])
+    return time.time()
+
+
+def get_worker_id(lease_conf) -> str:
+    """Returns ID of this worker in lease database"""
+    return lease_conf.get('worker_id', WORKER_ID)
+
+
+def claim(lease_conf, counter, source, span) -> tuple:
+    """Takes a lease on (counter, source, date span) unit.
+        Fails if an overlapping unit is leased by another worker and the lease has not expired.
+        Overlapping units which were not loaded (their workers died or failed) are taken over as a whole:
+        the span is extended to cover them. Returns (claimed span or None, whether units were taken over)"""
+    table = get_table_name(lease_conf)
+    span = (span[0], span[1])
+    con = get_connection(lease_conf)
+    try:
+        lock(lease_conf, con)
+        now = get_now(lease_conf, con)
+        while True:
+            rows = con.execute('''
+                SELECT worker, start_date, end_date, expires
+                FROM {table}
+                WHERE counter = ? AND source = ? AND start_date <= ? AND end_date >= ? AND done = 0
+            '''.format(table=table), (str(counter), source, span[1], span[0])).fetchall()
+            active = [r for r in rows if r[3] > now and r[0] != get_worker_id(lease_conf)]
+            if len(active) != 0:
+                con.rollback()
+                logger.info('Timespan {span} for counter_id = {counter} is leased by {worker}'
+                            .format(span=span, counter=counter, worker=active[0][0]))
+                return None, False
+            extended = (min([span[0]] + [r[1] for r in rows]), max([span[1]] + [r[2] for r in rows]))
+            if extended == span:
+                break
+            span = extended
+
+        # units taken over are replaced by the claimed one, as well as the loaded unit with the same span
+        con.execute('''
+            DELETE FROM {table}
+            WHERE counter = ? AND source = ?
+                AND ((start_date >= ? AND end_date <= ? AND done = 0) OR (start_date = ? AND end_date = ?))
+        '''.format(table=table), (str(counter), source, span[0], span[1], span[0], span[1]))
+        con.execute('INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, 0)'.format(table=table),
+                    (str(counter), source, span[0], span[1], get_worker_id(lease_conf),
+                     now + lease_conf.get('ttl', 600)))
+        con.commit()
+        if len(rows) != 0:
+            logger.warning('Timespan {span} for counter_id = {counter} was not loaded by {workers}, it is taken over'
+                           .format(span=span, counter=counter, workers=', '.join(sorted(set(r[0] for r in rows)))))
+        return span, len(rows) != 0
+    finally:
+        con.close()
+
+
+def update(lease_conf, counter, source, span, ttl, done=0) -> int:
+    """Sets lease of the unit held by this worker to expire in ttl seconds if it has not expired yet.
+        Returns number of updated leases, 0 means that the lease is lost"""
+    con = get_connection(lease_conf)
+    try:
+        now = get_now(lease_conf, con)
+        rowcount = con.execute('''
+            UPDATE {table}
+            SET expires = ?, done = ?
+            WHERE counter = ? AND source = ? AND start_date = ? AND end_date = ? AND worker = ? AND expires > ?
+        '''.format(table=get_table_name(lease_conf)),
+            (now + ttl, done, str(counter), source, span[0], span[1], get_worker_id(lease_conf), now)).rowcount
+        con.commit()
+        return rowcount
+    finally:
+        con.close()
+
+
+def complete(lease_conf, counter, source, span):
+    """Marks unit as loaded"""
+    if update(lease_conf, counter, source, span, 0, done=1) == 0:
+        raise LeaseLost('Lease on timespan {span} for counter_id = {counter} is lost'
+                        .format(span=span, counter=counter))
+
+
+def release(lease_conf, counter, source, span):
+    """Expires lease immediately, so other workers can pick the unit up"""
+    update(lease_conf, counter, source, span, 0)
+
+
+@contextmanager
+def renewing(lease_conf, counter, source, span):
+    """Keeps lease on the unit alive while the block is being executed.
+        Yields event which is set when the lease is lost, the block must stop loading then"""
+    ttl = lease_conf.get('ttl', 600)
+    stop = threading.Event()
+    lost = threading.Event()
+
+    def renew():
+        while not stop.wait(ttl / 3):
+            try:
+                if update(lease_conf, counter, source, span, ttl) == 0:
+                    logger.warning('Lease on timespan {span} for counter_id = {counter} is lost'
+                                   .format(span=span, counter=counter))
+                    lost.set()
+                    return
+            except Exception as e:
+                logger.warning('Unable to renew lease: {error}'.format(error=e))
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield lost
+    finally:
+        stop.set()
+        thread.join()
@@ -3,17 +3,24 @@ import datetime
 import logging
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
 import utils
+import dedup
+import part_cache
+import profiler
 
 logger = logging.getLogger('logs_api')
 
 HOST = 'https://api-metrika.yandex.ru'
 
+# keep-alive HTTP connections are reused between requests
+session = requests.Session()
+
 
 def get_active_counters(user_request) -> tuple:
     """Returns tuple of available counters as strings"""
-    reply = requests.get('{host}/management/v1/counters'.format(host=HOST),
-                         {'id': user_request.app_id, 'oauth_token': user_request.token})
+    reply = session.get('{host}/management/v1/counters'.format(host=HOST),
+                        {'id': user_request.app_id, 'oauth_token': user_request.token})
 
     counters = reply.json()['counters']
     cntrs = [str(c['id']) for c in counters if c['code_status'] == 'CS_OK']
@@ -26,11 +33,11 @@ def get_estimation(user_request):
     url = '{host}/management/v1/counter/{counter_id}/logrequests/evaluate?' \
         .format(host=HOST, counter_id=user_request.counter_id)
 
-    r = requests.get(url, {'date1': user_request.start_date_str,
-                           'date2': user_request.end_date_str,
-                           'source': user_request.source,
-                           'fields': ','.join(user_request.fields),
-                           'oauth_token': user_request.token})
+    r = session.get(url, {'date1': user_request.start_date_str,
+                          'date2': user_request.end_date_str,
+                          'source': user_request.source,
+                          'fields': ','.join(user_request.fields),
+                          'oauth_token': user_request.token})
     logger.debug(r.text)
     if r.status_code == 200:
         return json.loads(r.text)['log_request_evaluation']
@@ -87,11 +94,11 @@ def create_task(api_request):
     url = '{host}/management/v1/counter/{counter_id}/logrequests?' \
         .format(host=HOST, counter_id=api_request.user_request.counter_id)
 
-    r = requests.post(url, {'date1': api_request.date1_str,
-                            'date2': api_request.date2_str,
-                            'source': api_request.user_request.source,
-                            'fields': ','.join(api_request.user_request.fields),
-                            'oauth_token': api_request.user_request.token})
+    r = session.post(url, {'date1': api_request.date1_str,
+                           'date2': api_request.date2_str,
+                           'source': api_request.user_request.source,
+                           'fields': ','.join(api_request.user_request.fields),
+                           'oauth_token': api_request.user_request.token})
 
     logger.debug(r.text)
     if r.status_code == 200:
@@ -113,7 +120,7 @@ def update_status(api_request):
                 token=api_request.user_request.token,
                 host=HOST)
 
-    r = requests.get(url)
+    r = session.get(url)
     logger.debug(r.text)
     if r.status_code == 200:
         status = json.loads(r.text)['log_request']['status']
@@ -126,8 +133,20 @@ def update_status(api_request):
         raise ValueError(r.text)
 
 
-def save_data(api_request, part, destination):
-    """Loads data chunk from Logs API and saves to ClickHouse"""
+def iter_lines(response, chunk_size=1024 * 1024):
+    """Yields lines of response body, decompressing it while it is being downloaded"""
+    response.encoding = 'utf-8'
+    pending = ''
+    for chunk in response.iter_content(chunk_size, decode_unicode=True):
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    yield pending
+
+
+def download_part(api_request, part) -> list:
+    """Returns lines of data chunk from Logs API"""
     url = '{host}/management/v1/counter/{counter_id}/logrequest/{request_id}/part/{part}/download?oauth_token={token}' \
         .format(host=HOST,
                 counter_id=api_request.user_request.counter_id,
@@ -135,12 +154,31 @@ def save_data(api_request, part, destination):
                 part=part,
                 token=api_request.user_request.token)
 
-    r = requests.get(url)
+    r = session.get(url, stream=True, headers={'Accept-Encoding': 'gzip, deflate'})
     if r.status_code != 200:
         logger.debug(r.text)
         raise ValueError(r.text)
 
-    splitted_text = r.text.split('\n')
+    splitted_text = list(iter_lines(r))
+    logger.info('{wire} bytes downloaded (Content-Encoding: {encoding})'
+                .format(wire=r.raw.tell(), encoding=r.headers.get('Content-Encoding', 'identity')))
+    return splitted_text
+
+
+def get_part(api_request, part) -> list:
+    """Returns lines of data chunk from local part cache if enabled, otherwise from Logs API"""
+    if api_request.user_request.part_cache is None:
+        return download_part(api_request, part)
+
+    splitted_text = part_cache.load_part(api_request, part)
+    if splitted_text is None:
+        splitted_text = download_part(api_request, part)
+        part_cache.save_part(api_request, part, splitted_text)
+    return splitted_text
+
+
+def filter_data(api_request, part, splitted_text) -> list:
+    """Returns lines with the same number of columns as header, saves the rest to dump_path"""
     headers_num = len(splitted_text[0].split('\t'))
     splitted_text_filtered = list(filter(lambda x: len(x.split('\t')) == headers_num, splitted_text))
     num_filtered = len(splitted_text) - len(splitted_text_filtered)
@@ -162,13 +200,70 @@ def save_data(api_request, part, destination):
             with open(filtered_out_file, 'w') as fo:
                 fo.write('\n'.join(splitted_text_filtered_out))
 
-    output_data = '\n'.join(splitted_text_filtered)
-    output_data = output_data.replace(r"\'", "'")      # to correct escapes in params
-    output_data = bytes(output_data, encoding='utf8')
+    return splitted_text_filtered
 
-    destination.save_data(api_request.user_request, output_data, part)
 
-    api_request.status = 'saved'
+def encode_data(splitted_text) -> bytes:
+    """Returns lines joined into TSV content for destinations"""
+    output_data = '\n'.join(splitted_text)
+    output_data = output_data.replace(r"\'", "'")      # to correct escapes in params
+    return bytes(output_data, encoding='utf8')
+
+
+def save_to_destination(api_request, part, destination, splitted_text, output_data):
+    """Saves part to destination, dropping rows already loaded to it if deduplication is enabled"""
+    user_req = api_request.user_request
+    with profiler.stage('upload_' + destination.__name__, api_request, part):
+        if user_req.dedup:
+            splitted_text, new_ids = dedup.filter_rows(user_req, destination.__name__, splitted_text)
+            output_data = encode_data(splitted_text)
+
+        destination.save_data(user_req, output_data, part)
+
+        if user_req.dedup:
+            dedup.commit(user_req, destination.__name__, new_ids)
+
+
+def save_data(api_request, part, destinations, saved=None) -> dict:
+    """Loads data chunk from Logs API once and saves it to all destinations (in parallel).
+        Names of destinations the part is saved to are added to saved, destinations already in saved are skipped.
+        Returns dict {destination name: exception} for failed destinations"""
+    saved = set() if saved is None else saved
+    pending = [d for d in destinations if d.__name__ not in saved]
+    if len(pending) == 0:
+        return {}
+
+    with profiler.stage('download', api_request, part):
+        splitted_text = get_part(api_request, part)
+
+    with profiler.stage('filter', api_request, part):
+        splitted_text_filtered = filter_data(api_request, part, splitted_text)
+        del splitted_text
+        # with deduplication every destination gets its own set of rows
+        output_data = None if api_request.user_request.dedup else encode_data(splitted_text_filtered)
+
+    failed = {}
+
+    def save(destination):
+        try:
+            save_to_destination(api_request, part, destination, splitted_text_filtered, output_data)
+            saved.add(destination.__name__)
+        except Exception as e:
+            logger.critical('Saving part #{part} to {dest} failed: {error}'
+                            .format(part=part, dest=destination.__name__, error=e))
+            failed[destination.__name__] = e
+
+    # profiles are collected per thread, so destinations are loaded one by one while profiling
+    if len(pending) == 1 or profiler.profile_path is not None:
+        for destination in pending:
+            save(destination)
+    else:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            list(executor.map(save, pending))
+
+    if len(failed) == 0:
+        api_request.status = 'saved'
+    return failed
 
 
 def clean_data(api_request):
@@ -179,7 +274,7 @@ def clean_data(api_request):
                 token=api_request.user_request.token,
                 request_id=api_request.request_id)
 
-    r = requests.post(url)
+    r = session.post(url)
     logger.debug(r.text)
     if r.status_code != 200:
         raise ValueError(r.text)
@@ -1,10 +1,17 @@
+import os
 import time
 import datetime
 import sys
+import argparse
 import logging
+import json
 from collections import namedtuple
 import utils
 import logs_api
+import part_cache
+import profiler
+import leases
+import dedup
 import clickhouse
 import vertica
 
@@ -59,10 +66,17 @@ def build_user_request(conf, opt, counter=None, span=None):
         'Fields must be specified in conf'
     fields = conf['{source}_fields'.format(source=source)]
 
+    # only key fields and backfilled ones are requested to fill new columns for loaded dates
+    backfill = opt.backfill_fields is not None
+    if backfill:
+        backfill_fields = opt.backfill_fields.split(',')
+        assert all(f in fields for f in backfill_fields), 'Backfilled fields must be specified in conf'
+        fields = utils.get_key_fields(source) + [f for f in backfill_fields if f not in utils.get_key_fields(source)]
+
     # Creating data structure (immutable tuple) with initial user request
     UserRequest = namedtuple(
         "UserRequest",
-        "app_id token counter_id start_date_str end_date_str source fields retries retries_delay dump_path"
+        "app_id token counter_id start_date_str end_date_str source fields retries retries_delay dump_path dedup part_cache backfill"
     )
 
     user_req = UserRequest(
@@ -75,15 +89,35 @@ def build_user_request(conf, opt, counter=None, span=None):
         fields=tuple(fields),
         retries=conf['retries'],
         retries_delay=conf['retries_delay'],
-        dump_path=conf['dump_path']
+        dump_path=conf['dump_path'],
+        dedup=conf.get('dedup', False) and not backfill,
+        part_cache=conf.get('part_cache'),
+        backfill=backfill
     )
 
     utils.validate_user_request(user_req)  # unnecessary check
     return user_req
 
 
-def integrate_with_logs_api(user_req, dest):
-    """Attempt fetching data from Logs API and saving to dest (clickhouse, vertica)"""
+def integrate_with_logs_api(user_req, destinations, lease_lost=None):
+    """Attempt fetching data from Logs API and saving to destinations (clickhouse, vertica).
+        Loading is stopped with leases.LeaseLost as soon as lease_lost event is set"""
+    # Logs API tasks, parts saved to each destination and destinations which saved all parts of API request
+    # are kept between retries: a retry reuses the task (a new one may split data into other parts),
+    # so a failure of one destination doesn't make others load the same parts again
+    tasks, saved_parts, completed = {}, {}, {}
+    backfilled = set()
+
+    # destinations report dates of the request as missing, so IDs saved for them earlier are stale
+    if user_req.dedup:
+        for destination in destinations:
+            dedup.reset(user_req, destination.__name__)
+
+    # parts of backfill request are collected in staging tables, leftovers of failed requests are dropped
+    if user_req.backfill:
+        for destination in destinations:
+            destination.prepare_backfill(user_req)
+
     for i in range(user_req.retries):
         time.sleep(i * user_req.retries_delay)
         try:
@@ -91,83 +125,326 @@ def integrate_with_logs_api(user_req, dest):
             api_requests = logs_api.get_api_requests(user_req)
 
             for api_request in api_requests:
-                logger.info('### CREATING TASK for counter_id = {counter}, start = {start}, end = {end}'
-                            .format(counter=user_request.counter_id,
-                                    start=user_request.start_date_str, end=user_request.end_date_str))
-                logs_api.create_task(api_request)
-                delay = 20
-                while api_request.status != 'processed':
-                    logger.info('### DELAY %d secs' % delay)
-                    time.sleep(delay)
-                    logger.info('### CHECKING STATUS')
-                    api_request = logs_api.update_status(api_request)
-                    logger.info('API Request status: ' + api_request.status)
+                span = (api_request.date1_str, api_request.date2_str)
+                pending = [d for d in destinations if d.__name__ not in completed.setdefault(span, set())]
+                if len(pending) == 0:
+                    continue
+
+                cached_size = None
+                if span not in tasks and user_req.part_cache is not None:
+                    cached_size = part_cache.get_size(api_request)
+
+                if span in tasks:
+                    logger.info('### REUSING TASK for counter_id = {counter}, start = {start}, end = {end}'
+                                .format(counter=user_req.counter_id,
+                                        start=api_request.date1_str, end=api_request.date2_str))
+                    api_request.request_id, api_request.size = tasks[span]
+                elif cached_size is not None:
+                    # all parts were downloaded before, no need to prepare them again
+                    logger.info('### USING CACHED PARTS for counter_id = {counter}, start = {start}, end = {end}'
+                                .format(counter=user_req.counter_id,
+                                        start=api_request.date1_str, end=api_request.date2_str))
+                    api_request.size = cached_size
+                    api_request.request_id = None
+                    tasks[span] = (None, cached_size)
+                else:
+                    logger.info('### CREATING TASK for counter_id = {counter}, start = {start}, end = {end}'
+                                .format(counter=user_req.counter_id,
+                                        start=user_req.start_date_str, end=user_req.end_date_str))
+                    with profiler.stage('prepare', api_request):
+                        logs_api.create_task(api_request)
+                        delay = 20
+                        while api_request.status != 'processed':
+                            logger.info('### DELAY %d secs' % delay)
+                            time.sleep(delay)
+                            logger.info('### CHECKING STATUS')
+                            api_request = logs_api.update_status(api_request)
+                            logger.info('API Request status: ' + api_request.status)
+                    tasks[span] = (api_request.request_id, api_request.size)
+                    if user_req.part_cache is not None:
+                        part_cache.set_size(api_request)
 
                 logger.info('### SAVING DATA')
+                failed = {}
                 for part in range(api_request.size):
+                    if lease_lost is not None and lease_lost.is_set():
+                        raise leases.LeaseLost('Lease on timespan is lost, loading is stopped')
                     logger.info('Part #' + str(part))
-                    logs_api.save_data(api_request, part, dest)
+                    saved = saved_parts.setdefault(span + (part,), set())
+                    failed.update(logs_api.save_data(api_request, part,
+                                                     [d for d in pending if d.__name__ not in failed], saved))
+                completed[span].update(d.__name__ for d in pending if d.__name__ not in failed)
+                if len(failed) != 0:
+                    raise ValueError('Unable to save data to {dests}'.format(dests=', '.join(sorted(failed))))
+
+                if api_request.request_id is not None:
+                    logger.info('### CLEANING DATA')
+                    logs_api.clean_data(api_request)
 
-                logger.info('### CLEANING DATA')
-                logs_api.clean_data(api_request)
+            # loaded rows are updated once, when all parts of the request are collected
+            if user_req.backfill:
+                for destination in destinations:
+                    if destination.__name__ not in backfilled:
+                        logger.info('### APPLYING BACKFILL to {dest}'.format(dest=destination.__name__))
+                        destination.apply_backfill(user_req)
+                        backfilled.add(destination.__name__)
         except Exception as e:
             logger.critical('Iteration #{i} failed'.format(i=i + 1))
-            if i == user_req.retries - 1:
+            if i == user_req.retries - 1 or isinstance(e, leases.LeaseLost):
                 raise e
 
 
-if __name__ == '__main__':
+def get_destinations(opt) -> list:
+    """Returns list of destination modules chosen in options"""
+    if opt.dest is None:
+        return [clickhouse]
 
-    start_time = time.time()
+    destinations = []
+    for dest in opt.dest.split(','):
+        if dest == 'clickhouse':
+            destinations.append(clickhouse)
+        elif dest == 'vertica':
+            destinations.append(vertica)
+        else:
+            raise ValueError('Wrong argument: dest = ' + opt.dest)
+    return destinations
 
-    config = utils.get_config()
-    setup_logging(config)
-    options = utils.get_cli_options()
 
-    # choose from available destinations
-    if (options.dest is None) or (options.dest == 'clickhouse'):
-        destination = clickhouse
-    elif options.dest == 'vertica':
-        destination = vertica
+def get_missing_time_spans(user_request, destinations) -> list:
+    """Returns list of (date span, destinations where data for the span is missing)"""
+    if user_request.backfill:
+        # backfill is done for dates already loaded
+        spans_by_dest = {d.__name__: ((user_request.start_date_str, user_request.end_date_str),)
+                         for d in destinations}
     else:
-        raise ValueError('Wrong argument: dest = ' + options.dest)
+        spans_by_dest = {d.__name__: d.data_missing_time_spans(user_request) for d in destinations}
+    dest_by_name = {d.__name__: d for d in destinations}
+    return [(span, [dest_by_name[name] for name in names])
+            for span, names in utils.group_spans(spans_by_dest)]
 
-    user_request = build_user_request(config, options)
 
-    # choose counter [from config | from cli options | all avaibalbe counters]
-    if options.counter is None:
-        counters = (config['counter_id'],)
-    elif options.counter == 'all':
-        counters = logs_api.get_active_counters(user_request)
-    elif options.counter != 'all':
-        counters = (options.counter,)
+def get_counters(conf, opt):
+    """Returns counters to load [from config | from cli options | all avaibalbe counters]"""
+    if opt.counter is None:
+        return (conf['counter_id'],)
+    elif opt.counter == 'all':
+        return logs_api.get_active_counters(build_user_request(conf, opt))
     else:
-        raise ValueError('Wrong argument: counter = ' + options.counter)
+        return (opt.counter,)
+
 
+def load_counters(conf, opt, destinations, counters) -> dict:
+    """Loads data missing in destinations for every counter.
+        Returns dict {destination name: list of loaded date spans}"""
+    if 'leases' in conf:
+        return load_counters_leased(conf, opt, destinations, counters)
+
+    loaded_spans = {d.__name__: [] for d in destinations}
     for cntr in counters:
-        user_request = build_user_request(config, options, counter=cntr)
+        user_request = build_user_request(conf, opt, counter=cntr)
 
         # If data for specified period is already in database, script is skipped
-        missing_time_spans = destination.data_missing_time_spans(user_request)
+        missing_time_spans = get_missing_time_spans(user_request, destinations)
         logger.info('Required timespans for counter_id = {counter}, start = {start}, end = {end}: {ts}'
                     .format(counter=user_request.counter_id,
                             start=user_request.start_date_str, end=user_request.end_date_str,
-                            ts=missing_time_spans))
+                            ts=[(span, [d.__name__ for d in dests]) for span, dests in missing_time_spans]))
 
         if len(missing_time_spans) == 0:
             logger.info('### DATA IS PRESENT FOR counter={counter}, start_date={start}, end_date={end}'
                         .format(counter=cntr, start=user_request.start_date_str, end=user_request.end_date_str))
 
-        for timespan in missing_time_spans:
-            user_request = build_user_request(config, options, counter=cntr, span=timespan)
+        for timespan, dests in missing_time_spans:
+            user_request = build_user_request(conf, opt, counter=cntr, span=timespan)
             logger.info('User request: {user_request}'.format(user_request=user_request))
-            integrate_with_logs_api(user_request, destination)
+            integrate_with_logs_api(user_request, dests)
+            for dest in dests:
+                loaded_spans[dest.__name__].append(tuple(timespan))
+
+    return loaded_spans
+
+
+def load_counters_leased(conf, opt, destinations, counters) -> dict:
+    """Loads data missing in destinations for every counter, taking leases on (counter, source, date span)
+        units, so several workers can split the work. Returns dict {destination name: list of date spans
+        loaded by this worker}"""
+    lease_conf = conf['leases']
+    loaded_spans = {d.__name__: [] for d in destinations}
+    while True:
+        leased_by_others = 0
+        for cntr in counters:
+            user_request = build_user_request(conf, opt, counter=cntr)
+            for timespan, _ in get_missing_time_spans(user_request, destinations):
+                timespan, taken_over = leases.claim(lease_conf, cntr, opt.source, timespan)
+                if timespan is None:
+                    leased_by_others += 1
+                    continue
+                try:
+                    with leases.renewing(lease_conf, cntr, opt.source, timespan) as lease_lost:
+                        span_request = build_user_request(conf, opt, counter=cntr, span=timespan)
+                        if taken_over:
+                            # parts do not line up with days, so days with some rows may be incomplete:
+                            # the whole span is deleted and loaded again
+                            for destination in destinations:
+                                destination.delete_data(span_request)
+                            spans = [(timespan, destinations)]
+                        else:
+                            # another worker could finish part of the span before the lease was taken
+                            spans = get_missing_time_spans(span_request, destinations)
+                        for span, dests in spans:
+                            user_request = build_user_request(conf, opt, counter=cntr, span=span)
+                            logger.info('User request: {user_request}'.format(user_request=user_request))
+                            integrate_with_logs_api(user_request, dests, lease_lost)
+                            for dest in dests:
+                                loaded_spans[dest.__name__].append(tuple(span))
+                    leases.complete(lease_conf, cntr, opt.source, timespan)
+                except leases.LeaseLost as e:
+                    # the unit may be taken by another worker, it is left to that worker
+                    logger.warning('{error}, timespan {span} for counter_id = {counter} is skipped'
+                                   .format(error=e, span=timespan, counter=cntr))
+                except Exception as e:
+                    leases.release(lease_conf, cntr, opt.source, timespan)
+                    raise e
+
+        # wait for units leased by other workers: they are either loaded or picked up after lease expiration
+        if leased_by_others == 0:
+            return loaded_spans
+        logger.info('### {num} timespans are leased by other workers, DELAY {delay} secs'
+                    .format(num=leased_by_others, delay=lease_conf.get('poll_interval', 60)))
+        time.sleep(lease_conf.get('poll_interval', 60))
+
+
+DAEMON_MODES = {
+    # mode: (days ago loaded by mode, default time of day to start, mode whose incomplete data is replaced)
+    'regular_early': (1, '03:00', None),
+    'regular': (2, '05:00', 'regular_early'),
+}
+
+
+def delete_counters_data(conf, opt, destinations, counters):
+    """Deletes data for date range of options for every counter, so it is loaded again"""
+    for cntr in counters:
+        user_request = build_user_request(conf, opt, counter=cntr)
+        for destination in destinations:
+            destination.delete_data(user_request)
+
 
-    destination.clean_data(user_request.source)
+def get_daemon_status(status_file) -> dict:
+    """Returns daemon status saved by previous runs or a fresh one"""
+    status = {'last_loaded': {}}
+    if os.path.exists(status_file):
+        with open(status_file) as input_file:
+            status.update(json.loads(input_file.read()))
+    return status
+
+
+def run_daemon(conf, opt, destinations):
+    """Stays resident and loads regular and regular_early windows on schedule.
+        HTTP sessions and metadata caches of modules stay warm between cycles,
+        health and progress are written to daemon_status.json in dump_path"""
+    daemon_conf = conf.get('daemon', {})
+    poll_interval = daemon_conf.get('poll_interval', 60)
+    retry_interval = daemon_conf.get('retry_interval', 600)
+    lock_file = os.path.join(conf['dump_path'], 'daemon.lock')
+    status_file = os.path.join(conf['dump_path'], 'daemon_status.json')
+
+    # only one daemon may work with dump_path, otherwise windows could be loaded twice
+    lock = utils.acquire_lock(lock_file)
+    if lock is None:
+        raise RuntimeError('Daemon is already running: {lock} is locked'.format(lock=lock_file))
+
+    if opt.source is None:
+        sources = [src for src in ('visits', 'hits') if '{src}_fields'.format(src=src) in conf]
+    else:
+        sources = [opt.source]
+
+    status = get_daemon_status(status_file)
+    status.update(pid=os.getpid(), started=datetime.datetime.now(), state='idle', current=None)
+    next_attempt = {}
+    logger.info('### DAEMON STARTED for sources {sources}'.format(sources=sources))
+
+    try:
+        while True:
+            now = datetime.datetime.now()
+            for mode, (days_ago, default_time, replaced_mode) in sorted(DAEMON_MODES.items()):
+                run_time = datetime.datetime.strptime(daemon_conf.get(mode + '_time', default_time), '%H:%M').time()
+                target_date = (now - datetime.timedelta(days_ago)).date()
+                last_loaded = status['last_loaded'].get(mode)
+                if (now.time() < run_time) or (next_attempt.get(mode, now) > now) \
+                        or (last_loaded == target_date.strftime(utils.DATE_FORMAT)):
+                    continue
+
+                # catch up days missed while the daemon was down, data present in destination is skipped
+                if last_loaded is None:
+                    start_date = target_date
+                else:
+                    start_date = min(target_date,
+                                     datetime.datetime.strptime(last_loaded, utils.DATE_FORMAT).date()
+                                     + datetime.timedelta(1))
+                try:
+                    for source in sources:
+                        run_opt = argparse.Namespace(**dict(vars(opt), mode=None, source=source,
+                                                            start_date=start_date.strftime(utils.DATE_FORMAT),
+                                                            end_date=target_date.strftime(utils.DATE_FORMAT)))
+                        status.update(state='running', current={'mode': mode, 'source': source,
+                                                                 'start_date': run_opt.start_date,
+                                                                 'end_date': run_opt.end_date})
+                        utils.write_json_atomic(status_file, status)
+                        counters = get_counters(conf, run_opt)
+                        # days loaded by regular_early may lack some page views, they are loaded again
+                        replaced_loaded = status['last_loaded'].get(replaced_mode)
+                        if replaced_loaded is not None and replaced_loaded >= run_opt.start_date:
+                            delete_opt = argparse.Namespace(**dict(vars(run_opt),
+                                                                   end_date=min(run_opt.end_date, replaced_loaded)))
+                            delete_counters_data(conf, delete_opt, destinations, counters)
+                        loaded_spans = load_counters(conf, run_opt, destinations, counters)
+                        for destination in destinations:
+                            destination.clean_data(source, loaded_spans[destination.__name__])
+                    status['last_loaded'][mode] = target_date.strftime(utils.DATE_FORMAT)
+                    status['last_success'] = datetime.datetime.now()
+                    status['last_error'] = None
+                except Exception as e:
+                    logger.critical('Daemon run {mode} failed: {error}'.format(mode=mode, error=e))
+                    status['last_error'] = {'mode': mode, 'time': datetime.datetime.now(), 'error': str(e)}
+                    next_attempt[mode] = datetime.datetime.now() + datetime.timedelta(seconds=retry_interval)
+                status.update(state='idle', current=None)
+
+            status['heartbeat'] = datetime.datetime.now()
+            utils.write_json_atomic(status_file, status)
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        logger.info('### DAEMON STOPPED')
+        status.update(state='stopped', current=None)
+        utils.write_json_atomic(status_file, status)
+    finally:
+        lock.close()
+
+
+if __name__ == '__main__':
+
+    start_time = time.time()
+
+    config = utils.get_config()
+    setup_logging(config)
+    options = utils.get_cli_options()
+
+    # choose from available destinations
+    destinations = get_destinations(options)
+
+    if options.profile is not None:
+        profiler.enable(config['dump_path'], options.profile)
+
+    if options.mode == 'daemon':
+        run_daemon(config, options, destinations)
+        sys.exit(0)
+
+    loaded_spans = load_counters(config, options, destinations, get_counters(config, options))
+
+    for destination in destinations:
+        destination.clean_data(options.source, loaded_spans[destination.__name__])
 
     end_time = time.time()
     logger.info('### TOTAL TIME: %d minutes %d seconds' % (
         (end_time - start_time) / 60,
         (end_time - start_time) % 60
     ))
-
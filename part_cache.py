@@ -0,0 +1,116 @@
+import os
+import time
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+
+logger = logging.getLogger('logs_api')
+
+
+def get_cache_dir(user_req) -> str:
+    """Returns directory with cached parts"""
+    return os.path.join(user_req.dump_path, 'part_cache')
+
+
+def get_entry_dir(api_request) -> str:
+    """Returns directory with parts of API request: keyed by counter, source, fields and date range"""
+    user_req = api_request.user_request
+    fields_hash = hashlib.md5(','.join(user_req.fields).encode('utf8')).hexdigest()[:12]
+    entry = '{counter}_{source}_{fields}_{start}_{end}'.format(counter=user_req.counter_id,
+                                                               source=user_req.source,
+                                                               fields=fields_hash,
+                                                               start=api_request.date1_str,
+                                                               end=api_request.date2_str)
+    return os.path.join(get_cache_dir(user_req), entry)
+
+
+def get_part_file(api_request, part) -> str:
+    """Returns path of the cached part file"""
+    return os.path.join(get_entry_dir(api_request), 'part_{part}.tsv.gz'.format(part=part))
+
+
+def is_expired(entry_dir, max_age_hours) -> bool:
+    """Returns whether cached parts are too old to be trusted (data for recent days is still changing)"""
+    manifest_file = os.path.join(entry_dir, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return False
+    with open(manifest_file) as input_file:
+        created = json.loads(input_file.read())['created']
+    return time.time() - created > max_age_hours * 3600
+
+
+def get_size(api_request):
+    """Returns number of parts if all of them are cached, otherwise None"""
+    entry_dir = get_entry_dir(api_request)
+    manifest_file = os.path.join(entry_dir, 'manifest.json')
+    if not os.path.exists(manifest_file) \
+            or is_expired(entry_dir, api_request.user_request.part_cache.get('max_age_hours', 24)):
+        return None
+    with open(manifest_file) as input_file:
+        size = json.loads(input_file.read())['size']
+    for part in range(size):
+        if not os.path.exists(get_part_file(api_request, part)):
+            return None
+    return size
+
+
+def set_size(api_request):
+    """Starts a new cache entry for parts of a newly created task and saves their number.
+        Parts cached for other tasks are removed: a new task may split data into parts differently"""
+    entry_dir = get_entry_dir(api_request)
+    if os.path.exists(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.makedirs(entry_dir)
+    with open(os.path.join(entry_dir, 'manifest.json'), 'w') as output_file:
+        output_file.write(json.dumps({'size': api_request.size, 'created': time.time(),
+                                      'request_id': api_request.request_id}))
+
+
+def load_part(api_request, part):
+    """Returns cached lines of the part or None"""
+    part_file = get_part_file(api_request, part)
+    if not os.path.exists(part_file):
+        return None
+    with gzip.open(part_file, 'rt', encoding='utf8', newline='') as input_file:
+        lines = input_file.read().split('\n')
+    os.utime(get_entry_dir(api_request))  # mark entry as recently used
+    logger.info('Part #{part} is loaded from cache: {file}'.format(part=part, file=part_file))
+    return lines
+
+
+def save_part(api_request, part, lines):
+    """Saves downloaded lines of the part and evicts least recently used entries"""
+    part_file = get_part_file(api_request, part)
+    os.makedirs(os.path.dirname(part_file), exist_ok=True)
+    with gzip.open(part_file + '.tmp', 'wt', encoding='utf8', newline='', compresslevel=1) as output_file:
+        output_file.write('\n'.join(lines))
+    os.replace(part_file + '.tmp', part_file)
+    evict(api_request.user_request, exclude=get_entry_dir(api_request))
+
+
+def get_dir_size(path) -> int:
+    """Returns total size of files in directory"""
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def evict(user_req, exclude=None):
+    """Removes expired entries and least recently used ones while cache is larger than max_size_mb"""
+    cache_dir = get_cache_dir(user_req)
+    max_size = user_req.part_cache.get('max_size_mb', 1024) * 1024 * 1024
+    max_age_hours = user_req.part_cache.get('max_age_hours', 24)
+
+    entries = [os.path.join(cache_dir, e) for e in os.listdir(cache_dir)]
+    entries = sorted((os.path.getmtime(e), e) for e in entries if e != exclude)
+    total_size = sum(get_dir_size(e) for _, e in entries)
+    if exclude is not None:
+        total_size += get_dir_size(exclude)
+
+    for _, entry_dir in entries:
+        if (total_size <= max_size) and not is_expired(entry_dir, max_age_hours):
+            continue
+        entry_size = get_dir_size(entry_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= entry_size
+        logger.info('Evicted from part cache: {entry}'.format(entry=entry_dir))
@@ -0,0 +1,75 @@
+import os
+import time
+import cProfile
+import tracemalloc
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger('logs_api')
+
+# directory for profiles, profiling is disabled while it is None
+profile_path = None
+# number of top memory allocations written for every stage, snapshots are not taken if it is 0
+top_allocations = 0
+
+
+def enable(dump_path, top=0):
+    """Turns on profiling of pipeline stages, results are written to dump_path/profile"""
+    global profile_path, top_allocations
+    profile_path = os.path.join(dump_path, 'profile')
+    top_allocations = top
+    os.makedirs(profile_path, exist_ok=True)
+
+    summary_file = os.path.join(profile_path, 'summary.tsv')
+    if not os.path.exists(summary_file):
+        with open(summary_file, 'w') as output_file:
+            output_file.write('counter\tsource\tstart\tend\tpart\tstage\tseconds\tpeak_mb\n')
+    logger.info('Profiling is enabled: {path}'.format(path=profile_path))
+
+
+@contextmanager
+def stage(name, api_request, part=None):
+    """Profiles CPU time and peak memory of a pipeline stage for one part of API request.
+        Writes cProfile stats, top allocations at the end of the stage (if asked for) and a summary line.
+        Memory is traced only while the stage is being executed"""
+    if profile_path is None:
+        yield
+        return
+
+    user_req = api_request.user_request
+    profile = cProfile.Profile()
+    tracing = not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_time = time.time()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        elapsed = time.time() - start_time
+        peak = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot() if top_allocations > 0 else None
+        if tracing:
+            tracemalloc.stop()
+
+        prefix = os.path.join(profile_path, '{counter}_{source}_{start}_{end}_{part}_{stage}'
+                              .format(counter=user_req.counter_id, source=user_req.source,
+                                      start=api_request.date1_str, end=api_request.date2_str,
+                                      part='all' if part is None else part, stage=name))
+        profile.dump_stats(prefix + '.prof')
+        with open(prefix + '.mem.txt', 'w') as output_file:
+            output_file.write('peak: {peak} bytes\n'.format(peak=peak))
+            if snapshot is not None:
+                for stat in snapshot.statistics('lineno')[:top_allocations]:
+                    output_file.write(str(stat) + '\n')
+
+        with open(os.path.join(profile_path, 'summary.tsv'), 'a') as output_file:
+            output_file.write('{counter}\t{source}\t{start}\t{end}\t{part}\t{stage}\t{seconds:.3f}\t{peak:.1f}\n'
+                              .format(counter=user_req.counter_id, source=user_req.source,
+                                      start=api_request.date1_str, end=api_request.date2_str,
+                                      part='' if part is None else part, stage=name,
+                                      seconds=elapsed, peak=peak / 1024 / 1024))
+        logger.info('Stage {stage}: {seconds:.1f} seconds, peak memory {peak:.1f} MB'
+                    .format(stage=name, seconds=elapsed, peak=peak / 1024 / 1024))
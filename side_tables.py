@@ -0,0 +1,104 @@
+import re
+import json
+import logging
+import utils
+
+logger = logging.getLogger('logs_api')
+
+PREFIXES = {'visits': 'ym:s:', 'hits': 'ym:pv:'}
+
+
+def parse_array(value: str) -> list:
+    """Parses array literal of the form ['a','b'] or [1,2] from Logs API to list of strings"""
+    value = value.strip()
+    if value in ('', '[]'):
+        return []
+    value = value[1:-1]
+    if value.startswith("'"):
+        return [e.replace("\\'", "'").replace('\\\\', '\\') for e in re.split(r"'\s*,\s*'", value[1:-1])]
+    return [e.strip() for e in value.split(',')]
+
+
+def flatten_params(param: str) -> list:
+    """Returns list of (key, value) pairs of a visit parameter, nested keys are joined with dots"""
+    try:
+        obj = json.loads(param)
+    except ValueError:
+        return [('', param)]
+
+    pairs = []
+
+    def walk(prefix, node):
+        if isinstance(node, dict):
+            for key, child in node.items():
+                walk(key if prefix == '' else prefix + '.' + key, child)
+        elif isinstance(node, list):
+            for child in node:
+                walk(prefix, child)
+        else:
+            pairs.append((prefix, '' if node is None else str(node)))
+
+    walk('', obj)
+    return pairs
+
+
+def escape(value: str) -> str:
+    """Escapes value for TabSeparated format"""
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def element_type(array_type: str) -> str:
+    """Returns type of array elements: Array(UInt32) -> UInt32"""
+    return array_type[len('Array('):-1]
+
+
+def explode(source, data: bytes, get_column_name) -> list:
+    """Parses params and goals arrays of the part once and returns side tables as
+        list of (suffix, [(column, type)], [order by columns], TabSeparatedWithNames content)"""
+    lines = data.decode('utf8').split('\n')
+    header = lines[0].split('\t')
+    prefix = PREFIXES[source]
+    key_fields = utils.get_key_fields(source)
+    if any(f not in header for f in key_fields):
+        logger.warning('Side tables are skipped: fields {fields} are required'.format(fields=key_fields))
+        return []
+
+    field_types = utils.get_fields_config()
+    key_pos = [header.index(f) for f in key_fields]
+    key_columns = [(get_column_name(f), field_types[f]) for f in key_fields]
+    params_pos = header.index(prefix + 'params') if prefix + 'params' in header else None
+    goals_fields = [f for f in header if f.startswith(prefix + 'goals')]
+    goals_pos = [header.index(f) for f in goals_fields]
+
+    params_rows, goals_rows = [], []
+    for line in lines[1:]:
+        if line == '':
+            continue
+        values = line.split('\t')
+        key = '\t'.join(values[i] for i in key_pos)
+        if params_pos is not None:
+            for param in parse_array(values[params_pos]):
+                for param_key, param_value in flatten_params(param):
+                    params_rows.append('{key}\t{param_key}\t{param_value}'
+                                       .format(key=key, param_key=escape(param_key), param_value=escape(param_value)))
+        if len(goals_pos) != 0:
+            goals = [parse_array(values[i]) for i in goals_pos]
+            for goal in zip(*goals):
+                goals_rows.append(key + '\t' + '\t'.join(escape(v) for v in goal))
+
+    side_tables = []
+    if params_pos is not None:
+        columns = key_columns + [('Key', 'String'), ('Value', 'String')]
+        side_tables.append(('params', columns, [key_columns[0][0], key_columns[1][0], 'Key'],
+                            '\n'.join(['\t'.join(c[0] for c in columns)] + params_rows)))
+    if len(goals_pos) != 0:
+        # goalsID -> GoalID, goalsPrice -> GoalPrice
+        goal_columns = [(get_column_name(f).replace('Goals', 'Goal', 1), element_type(field_types[f]))
+                        for f in goals_fields]
+        columns = key_columns + goal_columns
+        order_by = [key_columns[0][0], key_columns[1][0]]
+        if prefix + 'goalsID' in goals_fields:
+            order_by.append(get_column_name(prefix + 'goalsID').replace('Goals', 'Goal', 1))
+        side_tables.append(('goals', columns, order_by,
+                            '\n'.join(['\t'.join(c[0] for c in columns)] + goals_rows)))
+    return [(t[0], t[1], t[2], bytes(t[3], encoding='utf8')) for t in side_tables]
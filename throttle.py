@@ -0,0 +1,93 @@
+import os
+import time
+import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+import utils
+
+logger = logging.getLogger('logs_api')
+
+
+class TokenBucket:
+    """Limits average rate of some amount (bytes, rows) per second, allowing bursts of one second"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Takes amount of tokens, waits until the debt is paid off if there is not enough of them"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            logger.debug('Throttling for {wait:.1f} secs'.format(wait=wait))
+            time.sleep(wait)
+
+
+def get_limits(throttle_conf, name, dump_path):
+    """Returns limits of inserts to destination from its throttle config"""
+    Limits = namedtuple('Limits', 'name bytes_bucket rows_bucket max_concurrent_inserts slots_path '
+                                  'backoff_retries backoff_delay')
+    bytes_per_sec = throttle_conf.get('bytes_per_sec', 0)
+    rows_per_sec = throttle_conf.get('rows_per_sec', 0)
+    return Limits(name=name,
+                  bytes_bucket=TokenBucket(bytes_per_sec) if bytes_per_sec > 0 else None,
+                  rows_bucket=TokenBucket(rows_per_sec) if rows_per_sec > 0 else None,
+                  max_concurrent_inserts=throttle_conf.get('max_concurrent_inserts', 0),
+                  slots_path=os.path.join(dump_path, 'insert_slots'),
+                  backoff_retries=throttle_conf.get('backoff_retries', 0),
+                  backoff_delay=throttle_conf.get('backoff_delay', 30))
+
+
+@contextmanager
+def insert_slot(limits, content: bytes):
+    """Waits until rate limits allow to insert content and takes one of max_concurrent_inserts slots.
+        Slots are lock files in dump_path, so they are shared by all processes on the host"""
+    if limits.bytes_bucket is not None:
+        limits.bytes_bucket.consume(len(content))
+    if limits.rows_bucket is not None:
+        limits.rows_bucket.consume(content.count(b'\n'))
+
+    if limits.max_concurrent_inserts <= 0:
+        yield
+        return
+
+    os.makedirs(limits.slots_path, exist_ok=True)
+    lock = None
+    while lock is None:
+        for i in range(limits.max_concurrent_inserts):
+            lock = utils.acquire_lock(os.path.join(limits.slots_path, '{name}_{i}.lock'.format(name=limits.name, i=i)))
+            if lock is not None:
+                break
+        else:
+            time.sleep(1)
+    try:
+        yield
+    finally:
+        lock.close()
+
+
+def with_backoff(limits, func, is_overloaded, is_busy=None):
+    """Calls func, retrying it with exponential delay while server reports overload
+        (func raises an error accepted by is_overloaded or is_busy returns True before the call)"""
+    for i in range(limits.backoff_retries + 1):
+        last_attempt = (i == limits.backoff_retries)
+        if (is_busy is not None) and not last_attempt and is_busy():
+            reason = 'server is busy'
+        else:
+            try:
+                return func()
+            except Exception as e:
+                if last_attempt or not is_overloaded(e):
+                    raise e
+                reason = str(e)
+        delay = limits.backoff_delay * 2 ** i
+        logger.warning('{name} is overloaded, DELAY {delay} secs: {reason}'
+                       .format(name=limits.name, delay=delay, reason=reason))
+        time.sleep(delay)
@@ -1,10 +1,15 @@
+import os
 import argparse
 import re
 import json
+import hashlib
+import datetime
 import requests
 
 DATE_FORMAT = '%Y-%m-%d'
 
+ID_FIELDS = {'visits': 'ym:s:visitID', 'hits': 'ym:pv:watchID'}
+
 
 class Structure:
     def __init__(self, **kwds):
@@ -22,17 +27,35 @@ def validate_user_request(user_request):
     assert user_request.source in ['hits', 'visits'], 'Invalid source'
 
 
+def get_key_fields(source) -> list:
+    """Returns fields identifying rows of source: counter, date and visit (hit) ID"""
+    prefix = 'ym:s:' if source == 'visits' else 'ym:pv:'
+    return [prefix + 'counterID', prefix + 'date', ID_FIELDS[source]]
+
+
+def get_backfill_suffix(user_request) -> str:
+    """Returns suffix of staging tables collecting all parts of backfill request: counter, dates and fields"""
+    return '{counter}_{start}_{end}_{fields}'.format(
+        counter=user_request.counter_id,
+        start=user_request.start_date_str.replace('-', ''),
+        end=user_request.end_date_str.replace('-', ''),
+        fields=hashlib.md5(','.join(user_request.fields).encode('utf8')).hexdigest()[:8])
+
+
 def validate_cli_options(options):
     """Validates command line options"""
-    assert options.source is not None, 'Source must be specified in CLI options'
+    assert (options.source is not None) or (options.mode == 'daemon'), \
+        'Source must be specified in CLI options'
     if options.mode is None:
         assert (options.start_date is not None) \
                and (options.end_date is not None), 'Dates or mode must be specified'
     else:
-        assert options.mode in ['history', 'regular', 'regular_early'], \
+        assert options.mode in ['history', 'regular', 'regular_early', 'daemon'], \
             'Wrong mode in CLI options'
-    assert options.dest in (None, 'clickhouse', 'vertica'),\
-        'If destition is specified, it must be in (clickhouse, vertica)'
+    assert (options.backfill_fields is None) or (options.mode not in ('daemon', 'regular_early')), \
+        'Backfill requires dates, history or regular mode'
+    assert (options.dest is None) or all(d in ('clickhouse', 'vertica') for d in options.dest.split(',')),\
+        'If destition is specified, it must be in (clickhouse, vertica) or a comma-separated list of them'
 
 
 def get_cli_options():
@@ -40,10 +63,15 @@ def get_cli_options():
     parser = argparse.ArgumentParser()
     parser.add_argument('-start_date', help='Start of period')
     parser.add_argument('-end_date', help='End of period')
-    parser.add_argument('-mode', help='Mode (one of [history, reqular, regular_early])')
-    parser.add_argument('-source', help='Source (hits or visits)')
-    parser.add_argument('-dest', help='Destination (clickhouse or vertica)')
+    parser.add_argument('-mode', help='Mode (one of [history, reqular, regular_early, daemon])')
+    parser.add_argument('-source', help='Source (hits or visits, daemon loads both if omitted)')
+    parser.add_argument('-dest', help='Destination (clickhouse, vertica or both: clickhouse,vertica)')
     parser.add_argument('-counter', help='Counter ID (counter_id or all)')
+    parser.add_argument('-backfill_fields',
+                        help='Comma-separated fields to fill for already loaded dates (columns are added if missing)')
+    parser.add_argument('-profile', nargs='?', const=0, type=int, metavar='TOP_ALLOCATIONS',
+                        help='Write CPU profiles and peak memory of pipeline stages to dump_path '
+                             '(and top memory allocations if their number is given)')
     options = parser.parse_args()
     validate_cli_options(options)
 
@@ -93,3 +121,90 @@ def get_fields_config(dbtype='clickhouse') -> dict:
     with open('./configs/{prefix}_types.json'.format(prefix=prefix)) as input_file:
         ch_field_types = json.loads(input_file.read())
     return ch_field_types
+
+
+def get_missing_spans(start_date_str, end_date_str, present_dates) -> tuple:
+    """Returns tuple of date spans (start_date, end_date) between start and end dates
+        which are not in present_dates (list of datetime.date)"""
+    start_date = datetime.datetime.strptime(start_date_str, DATE_FORMAT).date()
+    end_date = datetime.datetime.strptime(end_date_str, DATE_FORMAT).date()
+    required = [start_date + datetime.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    missing = [d for d in required if d not in present_dates]
+
+    # convert list of individual dates to list of date spans [(start_i, end_i)]
+    spans, span = [], []
+    for i in range(len(missing)):
+        if len(span) == 0:
+            span.append(missing[i])
+        if missing[i] - datetime.timedelta(days=1) <= span[-1]:
+            span.append(missing[i])
+        else:
+            spans.append(('{:%Y-%m-%d}'.format(span[0]), '{:%Y-%m-%d}'.format(span[-1])))
+            span = [missing[i]]
+        if i + 1 == len(missing):
+            spans.append(('{:%Y-%m-%d}'.format(span[0]), '{:%Y-%m-%d}'.format(span[-1])))
+    return tuple(spans)
+
+
+def merge_spans(spans) -> list:
+    """Returns sorted list of non-overlapping date spans covering the same days"""
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= (datetime.datetime.strptime(merged[-1][1], DATE_FORMAT)
+                                + datetime.timedelta(1)).strftime(DATE_FORMAT):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def group_spans(spans_by_key) -> list:
+    """Splits date spans of several keys into spans with the same set of keys.
+        Returns sorted list of ((start_date, end_date), [keys])"""
+    days = {}
+    for key, spans in spans_by_key.items():
+        for span in spans:
+            day = datetime.datetime.strptime(span[0], DATE_FORMAT).date()
+            end_date = datetime.datetime.strptime(span[1], DATE_FORMAT).date()
+            while day <= end_date:
+                days.setdefault(day, set()).add(key)
+                day += datetime.timedelta(1)
+
+    groups = []
+    for day in sorted(days):
+        keys = sorted(days[day])
+        if groups and (groups[-1][1] == keys) and (groups[-1][0][1] == day - datetime.timedelta(1)):
+            groups[-1][0][1] = day
+        else:
+            groups.append(([day, day], keys))
+    return [(('{:%Y-%m-%d}'.format(g[0][0]), '{:%Y-%m-%d}'.format(g[0][1])), g[1]) for g in groups]
+
+
+def acquire_lock(path):
+    """Takes an exclusive non-blocking lock on file, returns opened file or None if it is already locked.
+        The lock is released by the OS when the process exits, so a crashed process never leaves it stale"""
+    lock_file = open(path, 'a+')
+    try:
+        try:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except ImportError:
+            import msvcrt
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except (IOError, OSError):
+        lock_file.close()
+        return None
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    return lock_file
+
+
+def write_json_atomic(path, obj):
+    """Writes object as JSON so that readers never see a partially written file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as output_file:
+        output_file.write(json.dumps(obj, sort_keys=True, indent=2, default=str))
+    os.replace(tmp_path, path)
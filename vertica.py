@@ -1,10 +1,11 @@
 import os
-import datetime
 import logging
 import pyodbc
 import gzip
 from collections import namedtuple
 import utils
+import throttle
+import dedup
 
 config = utils.get_config()
 VT_HOST = config['vertica']['host']
@@ -13,9 +14,17 @@ VT_PASSWORD = config['vertica']['password']
 VT_VISITS_TABLE = config['vertica']['visits_table']
 VT_HITS_TABLE = config['vertica']['hits_table']
 VT_DATABASE = config['vertica']['database']
+VT_COMPRESSION_LEVEL = config['vertica'].get('compression_level', 9)
+VT_PARTITION_BY = config['vertica'].get('partition_by')
+VT_THROTTLE = config['vertica'].get('throttle', {})
 
 logger = logging.getLogger('logs_api')
 
+# tables with columns already reconciled with config
+reconciled_tables = set()
+
+limits = throttle.get_limits(VT_THROTTLE, 'vertica', config['dump_path'])
+
 
 def get_message(name: str) -> str:
     """Returns errors and warning string"""
@@ -62,9 +71,12 @@ def get_data(handler, query: str) -> list:
     return rows
 
 
-def upload(user_req, handler, content: bytes, part):
-    """Uploads data to table in Vertica"""
-    dump_file = os.path.join(user_req.dump_path, 'content.tsv.gz')
+def upload(user_req, handler, content: bytes, part, table=None):
+    """Uploads data to table in Vertica (source table by default)"""
+    dump_file = os.path.join(user_req.dump_path, 'content_{counter}_{start}_{end}_{part}.tsv.gz'
+                             .format(counter=user_req.counter_id,
+                                     start=user_req.start_date_str, end=user_req.end_date_str,
+                                     part=part))
 
     rejected_file = os.path.join(user_req.dump_path, 'rejected_{counter}_{start}_{end}_{part}.txt'
                                  .format(counter=user_req.counter_id,
@@ -76,19 +88,25 @@ def upload(user_req, handler, content: bytes, part):
                                            start=user_req.start_date_str, end=user_req.end_date_str,
                                            part=part))
 
-    table = get_source_table_name(user_req.source)
+    table = table or get_source_table_name(user_req.source)
+    # columns are listed by the header, as their order in table may differ from the order of fields in config
+    header = content.split(b'\n', 1)[0].decode('utf8').split('\t')
+    columns = ', '.join(map(get_vt_field_name, header))
 
-    with gzip.open(dump_file, 'w') as data_dump:
+    with gzip.open(dump_file, 'w', compresslevel=VT_COMPRESSION_LEVEL) as data_dump:
         data_dump.write(content)
+    logger.info('{raw} bytes compressed to {wire} bytes (gzip)'
+                .format(raw=len(content), wire=os.path.getsize(dump_file)))
 
     query = """
-            COPY {table}
+            COPY {table} ({columns})
             FROM LOCAL '{file}'
             GZIP DELIMITER E'\t'
             SKIP 1
             REJECTED DATA '{rejected}'
             EXCEPTIONS '{exceptions}';
-        """.format(table=table, file=dump_file, rejected=rejected_file, exceptions=exceptions_file)
+        """.format(table=table, columns=columns, file=dump_file, rejected=rejected_file,
+                   exceptions=exceptions_file)
 
     try:
         handler.cursor.execute(query)
@@ -163,6 +181,38 @@ def drop_table(handler, source):
     except Exception as e:
         logger.critical('Unable to DROP table ' + table_name)
         raise e
+    dedup.clear_index(config['dump_path'], 'vertica', source)
+
+
+def get_partition_expression(partition_by) -> str:
+    """Returns partition expression for partitioning by month or by date.
+        Old days are grouped into months and years, so long history stays within the limit of partitions"""
+    if partition_by == 'month':
+        return 'EXTRACT(YEAR FROM date) * 100 + EXTRACT(MONTH FROM date)'
+    elif partition_by == 'date':
+        return 'date GROUP BY CALENDAR_HIERARCHY_DAY(date, 2, 2)'
+    else:
+        raise ValueError('Wrong argument: partition_by = ' + partition_by)
+
+
+def get_table_partition_expression(handler, source) -> str:
+    """Returns partition expression of existing table ('' if table is not partitioned)"""
+    table_name = get_source_table_name(source).lower()
+    rows = get_data(handler, '''
+        SELECT partition_expression
+        FROM v_catalog.tables
+        WHERE lower(table_schema || '.' || table_name) = '{table}' OR lower(table_name) = '{table}';
+    '''.format(table=table_name))
+    if len(rows) == 0 or rows[0][0] is None:
+        return ''
+    return rows[0][0]
+
+
+def get_partition_keys(partition_expression, span) -> tuple:
+    """Returns min and max partition keys for date span"""
+    if 'MONTH' in partition_expression.upper():
+        return span[0][:7].replace('-', ''), span[1][:7].replace('-', '')
+    return span[0], span[1]
 
 
 def create_table(handler, source, fields):
@@ -171,7 +221,8 @@ def create_table(handler, source, fields):
         CREATE TABLE {table_name} (
             {fields}
         ) ORDER BY {order_clause}
-          SEGMENTED BY HASH({segmentation_clause}) ALL NODES;
+          SEGMENTED BY HASH({segmentation_clause}) ALL NODES
+          {partition_clause};
     '''
     field_tmpl = '{name} {type}'
     field_statements = []
@@ -184,6 +235,13 @@ def create_table(handler, source, fields):
     order_clause = ', '.join(vt_fields[:5])
     segmentation_clause = ', '.join(vt_fields[:3])
 
+    partition_clause = ''
+    if VT_PARTITION_BY is not None:
+        if 'date' in vt_fields:
+            partition_clause = 'PARTITION BY ' + get_partition_expression(VT_PARTITION_BY)
+        else:
+            logger.warning('Table {name} is not partitioned: date field is required'.format(name=table_name))
+
     for i in range(len(fields)):
         field_statements.append(field_tmpl.format(name=vt_fields[i],
                                                   type=vt_field_types[fields[i]]))
@@ -191,6 +249,7 @@ def create_table(handler, source, fields):
     query = tmpl.format(table_name=table_name,
                         order_clause=order_clause,
                         segmentation_clause=segmentation_clause,
+                        partition_clause=partition_clause,
                         fields=',\n'.join(field_statements))
 
     try:
@@ -202,15 +261,159 @@ def create_table(handler, source, fields):
         raise e
 
 
+def get_columns(handler, source) -> list:
+    """Returns list of column names of the table"""
+    rows = get_data(handler, '''
+        SELECT column_name
+        FROM v_catalog.columns
+        WHERE lower(table_schema || '.' || table_name) = '{table}' OR lower(table_name) = '{table}';
+    '''.format(table=get_source_table_name(source).lower()))
+    return [r[0].lower() for r in rows]
+
+
+def reconcile_table(handler, source):
+    """Adds columns for fields from config which are missing in existing table"""
+    table_name = get_source_table_name(source)
+    vt_field_types = utils.get_fields_config('vertica')
+    columns = get_columns(handler, source)
+    for field in config['{source}_fields'.format(source=source)]:
+        if get_vt_field_name(field) not in columns:
+            query = 'ALTER TABLE {table} ADD COLUMN {name} {type};'.format(table=table_name,
+                                                                          name=get_vt_field_name(field),
+                                                                          type=vt_field_types[field])
+            try:
+                handler.cursor.execute(query)
+                logger.info('Column {name} is added to {table}'.format(name=get_vt_field_name(field), table=table_name))
+            except Exception as e:
+                logger.critical('Unable to ADD COLUMN {name} to {table}'.format(name=get_vt_field_name(field),
+                                                                                table=table_name))
+                disconnect(handler)
+                raise e
+
+
+def get_backfill_table_name(user_req) -> str:
+    """Returns name of staging table collecting all parts of backfill request"""
+    return '{table}_backfill_{suffix}'.format(table=get_source_table_name(user_req.source),
+                                              suffix=utils.get_backfill_suffix(user_req))
+
+
+def prepare_backfill(user_req):
+    """Drops staging table left by a failed backfill request, so its data is not mixed with the new one"""
+    handler = get_handler()
+    try:
+        handler.cursor.execute('DROP TABLE IF EXISTS {table};'.format(table=get_backfill_table_name(user_req)))
+    finally:
+        disconnect(handler)
+
+
+def backfill(user_req, handler, data, part=None):
+    """Copies part of backfill data (key fields and backfilled ones) to staging table of the request,
+        rows are updated by apply_backfill when all parts are loaded"""
+    staging_table = get_backfill_table_name(user_req)
+    vt_field_types = utils.get_fields_config('vertica')
+    try:
+        handler.cursor.execute('CREATE TABLE IF NOT EXISTS {table} ({fields}) UNSEGMENTED ALL NODES;'
+                               .format(table=staging_table,
+                                       fields=', '.join('{name} {type}'.format(name=get_vt_field_name(f),
+                                                                               type=vt_field_types[f])
+                                                        for f in user_req.fields)))
+    except Exception as e:
+        logger.critical('Unable to CREATE table ' + staging_table)
+        disconnect(handler)
+        raise e
+    upload(user_req, handler, data, part, table=staging_table)
+
+
+def apply_backfill(user_req):
+    """Fills columns of already loaded rows of the date range by their visit (hit) ID from staging table
+        with all parts of backfill request, so the rows are updated once for the whole request"""
+    table_name = get_source_table_name(user_req.source)
+    staging_table = get_backfill_table_name(user_req)
+    id_column = get_vt_field_name(utils.ID_FIELDS[user_req.source])
+    key_columns = list(map(get_vt_field_name, utils.get_key_fields(user_req.source)))
+    columns = [c for c in map(get_vt_field_name, user_req.fields) if c not in key_columns]
+
+    handler = get_handler()
+    try:
+        handler.cursor.execute('''
+            UPDATE {table}
+            SET {updates}
+            FROM {staging} s
+            WHERE {table}.{id} = s.{id}
+                AND {table}.date BETWEEN '{start_date}' AND '{end_date}'
+                AND {table}.counter_id = {counter};
+        '''.format(table=table_name, staging=staging_table, id=id_column,
+                   updates=', '.join('{name} = s.{name}'.format(name=c) for c in columns),
+                   start_date=user_req.start_date_str, end_date=user_req.end_date_str,
+                   counter=user_req.counter_id))
+        handler.con.commit()
+        handler.cursor.execute('DROP TABLE IF EXISTS {table};'.format(table=staging_table))
+    except Exception as e:
+        logger.critical('Unable to backfill {columns} in {table}'.format(columns=columns, table=table_name))
+        disconnect(handler)
+        raise e
+    disconnect(handler)
+
+
+def is_overloaded(error) -> bool:
+    """Returns whether load failed because server is overloaded"""
+    message = str(error)
+    return any(m in message for m in ('Too many ROS containers', 'Insufficient resources',
+                                      'Timed out waiting for resource'))
+
+
 def save_data(user_req, data, part=None):
+    """Inserts data into Vertica table within throttle limits, every attempt uses a new connection"""
+    with throttle.insert_slot(limits, data):
+        throttle.with_backoff(limits, lambda: insert(user_req, data, part), is_overloaded)
+
+
+def insert(user_req, data, part=None):
     """Inserts data into Vertica table"""
     handler = get_handler()
 
     if not is_table_present(handler, user_req.source):
+        if user_req.backfill:
+            disconnect(handler)
+            raise ValueError('Unable to backfill: table {table} does not exist'
+                             .format(table=get_source_table_name(user_req.source)))
         create_table(handler, user_req.source, user_req.fields)
+    elif get_source_table_name(user_req.source) not in reconciled_tables:
+        reconcile_table(handler, user_req.source)
+    reconciled_tables.add(get_source_table_name(user_req.source))
+
+    if user_req.backfill:
+        backfill(user_req, handler, data, part)
+    else:
+        upload(user_req, handler, data, part)
+    disconnect(handler)
+
 
-    upload(user_req, handler, data, part)
+def delete_data(user_request):
+    """Deletes rows of the counter for date range of the request, so it can be loaded again"""
+    handler = get_handler()
+
+    if not is_table_present(handler, user_request.source):
+        disconnect(handler)
+        return
+
+    table_name = get_source_table_name(user_request.source)
+    try:
+        handler.cursor.execute('''
+            DELETE FROM {table}
+            WHERE date BETWEEN '{start_date}' AND '{end_date}'
+                AND counter_id = {counter};
+        '''.format(table=table_name, start_date=user_request.start_date_str,
+                   end_date=user_request.end_date_str, counter=user_request.counter_id))
+        handler.con.commit()
+    except Exception as e:
+        logger.critical('Unable to DELETE data from {table}'.format(table=table_name))
+        disconnect(handler)
+        raise e
     disconnect(handler)
+    logger.info('Data for counter_id = {counter}, {start} - {end} is deleted from {table}'
+                .format(counter=user_request.counter_id, start=user_request.start_date_str,
+                        end=user_request.end_date_str, table=table_name))
 
 
 def is_data_present(user_request) -> bool:
@@ -262,35 +465,32 @@ def data_missing_time_spans(user_request) -> tuple:
     else:
         # find missing dates
         dates = [d[0] for d in rows]
-        start_date = datetime.datetime.strptime(user_request.start_date_str, utils.DATE_FORMAT)
-        end_date = datetime.datetime.strptime(user_request.end_date_str, utils.DATE_FORMAT)
-        required = [datetime.datetime.date(start_date + datetime.timedelta(days=i)) for i in range((end_date - start_date).days + 1)]
-        missing = [d for d in required if d not in dates]
-
-        # convert list of individual dates to list of date spans [(start_i, end_i)]
-        spans, span = [], []
-        for i in range(len(missing)):
-            if len(span) == 0:
-                span.append(missing[i])
-            if missing[i] - datetime.timedelta(days=1) <= span[-1]:
-                span.append(missing[i])
-            else:
-                spans.append(('{:%Y-%m-%d}'.format(span[0]), '{:%Y-%m-%d}'.format(span[-1])))
-                span = [missing[i]]
-            if i + 1 == len(missing):
-                spans.append(('{:%Y-%m-%d}'.format(span[0]), '{:%Y-%m-%d}'.format(span[-1])))
-        return tuple(spans)
+        return utils.get_missing_spans(user_request.start_date_str, user_request.end_date_str, dates)
 
 
-def clean_data(source):
-    """Analyze table statistics"""
+def clean_data(source, spans=()):
+    """Analyze statistics for partitions touched by loaded date spans (whole table if it is not partitioned)"""
+    if len(spans) == 0:
+        return
+
     handler = get_handler()
 
     if is_table_present(handler, source):
         table = get_source_table_name(source)
+        partition_expression = get_table_partition_expression(handler, source)
+        columns = ','.join(map(get_vt_field_name, config['{source}_fields'.format(source=source)]))
         try:
-            handler.cursor.execute("""SELECT ANALYZE_STATISTICS('{table}');""".format(table=table))
+            if partition_expression == '':
+                handler.cursor.execute("""SELECT ANALYZE_STATISTICS('{table}');""".format(table=table))
+            else:
+                for span in utils.merge_spans(spans):
+                    min_key, max_key = get_partition_keys(partition_expression, span)
+                    logger.info('Analyze statistics for {table}, partitions {min_key} - {max_key}'
+                                .format(table=table, min_key=min_key, max_key=max_key))
+                    handler.cursor.execute("""SELECT ANALYZE_STATISTICS_PARTITION('{table}', '{min_key}', '{max_key}',
+                                                                                  '{columns}');"""
+                                           .format(table=table, min_key=min_key, max_key=max_key, columns=columns))
         except Exception as e:
             logger.warning('Unable to analyze statistics for {table}.'.format(table=table))
 
-    disconnect(handler)
\ No newline at end of file
+    disconnect(handler)